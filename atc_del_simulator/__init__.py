@@ -8,16 +8,20 @@ __all__ = [
     "AdsConfig",
     "get_ifr_flight_plans",
     "fetch_aircraft",
+    "fetch_flight_plan_details",
     "fetch_operator",
     "generate_vfr_flight_plans",
     "get_rules_info",
+    "warm_up_aeroapi_connection",
 ]
 
 from atc_del_simulator.ads_config import AdsConfig
 from atc_del_simulator.atc_del_simulator import (
     get_ifr_flight_plans,
     fetch_aircraft,
+    fetch_flight_plan_details,
     fetch_operator,
     generate_vfr_flight_plans,
     get_rules_info,
+    warm_up_aeroapi_connection,
 )
@@ -1,74 +1,233 @@
 """Represents the config of the ADS"""
+import atexit
 import json
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from rich.console import Console
 from tinydb import TinyDB
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 50
+HTTP_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# METARs are issued at most every 30 minutes, so a few minutes old copy is still current
+AVWX_CACHE_RULES = {
+    "/metar/": 300,
+}
+# Settings reachable through get_property and set_property, internal and derived attributes are left out
+CONFIG_PROPERTIES = (
+    "aeroapi_session",
+    "aeroapi_token",
+    "avwx_session",
+    "avwx_token",
+    "database",
+    "db_connection",
+    "details",
+    "use_cache",
+    "rich_console",
+    "rules_file",
+    "rules",
+    "verbose",
+)
+
+
+class CachedSession(requests.Session):
+    """Requests session which keeps successful GET responses in memory for URLs matching one of the cache rules
+
+    The cache only lives as long as the process, persistence across runs is left to the TinyDB database.
+    """
+
+    def __init__(self, cache_rules=None):
+        super().__init__()
+        self.cache_rules = cache_rules or {}
+        self.response_cache = {}
+        self.cache_lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        """Returns a cached response if one is still valid, otherwise performs the GET request"""
+        expire_after = next((expiry for path, expiry in self.cache_rules.items() if path in url), 0)
+        if not expire_after:
+            return super().get(url, **kwargs)
+        # The headers carry the API token, so a response is never served to a session using another token
+        headers = {**self.headers, **(kwargs.get("headers") or {})}
+        cache_key = (url, tuple(sorted((kwargs.get("params") or {}).items())), tuple(sorted(headers.items())))
+        # Concurrent requests wait for the first one and reuse its response
+        with self.cache_lock:
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response and cached_response[0] > time.monotonic():
+                return cached_response[1]
+            response = super().get(url, **kwargs)
+            if response.ok:
+                self.response_cache[cache_key] = (time.monotonic() + expire_after, response)
+            return response
+
+
+class OrjsonStorage(JSONStorage):
+    """JSON file storage which parses and serializes the database with orjson"""
+
+    def read(self):
+        """Reads the database file, returning None for an empty file so TinyDB initializes it"""
+        self._handle.seek(0, os.SEEK_END)
+        if not self._handle.tell():
+            return None
+        self._handle.seek(0)
+        return orjson.loads(self._handle.read())
+
+    def write(self, data):
+        """Writes the full database to the file"""
+        self._handle.seek(0)
+        self._handle.write(orjson.dumps(data).decode("utf-8"))
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._handle.truncate()
+
+
+def create_session(cache_rules=None):
+    """Creates a requests session with a sized connection pool and retries on transient errors"""
+    session = CachedSession(cache_rules=cache_rules)
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=HTTP_RETRY_STATUS_CODES, raise_on_status=False),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class AdsConfig:
     """Class representing the ADS Config with relevant data to be shared across methods"""
 
+    # Slots keep attribute access cheap on the hot paths, get_property and set_property remain for compatibility
+    __slots__ = (
+        "aeroapi_session",
+        "aeroapi_token",
+        "avwx_session",
+        "avwx_token",
+        "database",
+        "db_connection",
+        "db_lock",
+        "departure_keys",
+        "details",
+        "has_aeroapi_key",
+        "has_avwx_key",
+        "ifr_departure_index",
+        "use_cache",
+        "_rich_console",
+        "rules_file",
+        "_rules",
+        "rules_details_cache",
+        "verbose",
+    )
+
     def __init__(self, aeroapi_token="", avwx_token="", database="", verbose=False):
-        self.conf = {
-            "aeroapi_session": requests.Session(),
-            "aeroapi_token": aeroapi_token,
-            "avwx_session": requests.Session(),
-            "avwx_token": avwx_token,
-            "database": database,
-            "db_connection": None,
-            "details": False,
-            "use_cache": False,
-            "rich_console": Console(),
-            "rules_file": None,
-            "rules": {},
-            "verbose": verbose,
-        }
+        self.aeroapi_session = create_session()
+        self.aeroapi_token = aeroapi_token
+        self.avwx_session = create_session(cache_rules=AVWX_CACHE_RULES)
+        self.avwx_token = avwx_token
+        self.database = database
+        self.db_connection = None
+        self.db_lock = threading.Lock()
+        self.departure_keys = None
+        self.details = False
+        self.has_aeroapi_key = False
+        self.has_avwx_key = False
+        self.use_cache = False
+        self._rich_console = None
+        self.rules_file = None
+        self.rules = {}
+        self.verbose = verbose
         self.set_api_token(session_name="aeroapi_session", api_token=aeroapi_token)
         self.set_api_token(session_name="avwx_session", api_token=avwx_token)
 
+    @property
+    def rich_console(self):
+        """The rich console, created on first use as it probes the terminal when created"""
+        if self._rich_console is None:
+            self._rich_console = Console()
+        return self._rich_console
+
+    @rich_console.setter
+    def rich_console(self, rich_console):
+        self._rich_console = rich_console
+
+    @property
+    def rules(self):
+        """The loaded rules, setting them also rebuilds the structures derived from them"""
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        self._rules = rules
+        self.rules_details_cache = {}
+        # Group the IFR departures of each runway configuration by SID, so a flight plan can jump to its SID directly
+        self.ifr_departure_index = {}
+        for runway_configuration, ifr_departures in rules.get("ifr_departures", {}).items():
+            sid_index = self.ifr_departure_index.setdefault(runway_configuration, {})
+            for ifr_departure in ifr_departures:
+                sid_index.setdefault(ifr_departure["sid"], []).append(ifr_departure)
+
     def get_property(self, property_name):
         """Get a property of the config"""
-        return self.conf.get(property_name)
+        if property_name in CONFIG_PROPERTIES:
+            return getattr(self, property_name)
+        return None
 
     def set_property(self, property_name, property_value):
         """Set a property of the config"""
-        if property_name in self.conf:
-            self.conf[property_name] = property_value
-            return self.conf.get(property_name)
-        raise KeyError(f"{property_name} is not a valid configuration property")
+        if property_name not in CONFIG_PROPERTIES:
+            raise KeyError(f"{property_name} is not a valid configuration property")
+        if property_name == "aeroapi_token":
+            self.set_api_token(session_name="aeroapi_session", api_token=property_value)
+        elif property_name == "avwx_token":
+            self.set_api_token(session_name="avwx_session", api_token=property_value)
+        else:
+            setattr(self, property_name, property_value)
+        return getattr(self, property_name)
 
     def set_api_token(self, session_name, api_token):
         """Set the API token for different sessions"""
         if session_name == "aeroapi_session":
-            self.set_property("aeroapi_token", api_token)
-            self.conf["aeroapi_session"].headers.update(
-                {"Accept": "application/json; charset=UTF-8", "x-apikey": api_token}
-            )
+            self.aeroapi_token = api_token
+            self.has_aeroapi_key = bool(api_token)
+            self.aeroapi_session.headers.update({"Accept": "application/json; charset=UTF-8", "x-apikey": api_token})
         elif session_name == "avwx_session":
-            self.set_property("avwx_token", api_token)
-            self.conf["avwx_session"].headers.update(
-                {"Accept": "application/json; charset=UTF-8", "Authorization": api_token}
-            )
+            self.avwx_token = api_token
+            self.has_avwx_key = bool(api_token)
+            self.avwx_session.headers.update({"Accept": "application/json; charset=UTF-8", "Authorization": api_token})
 
     def start_db(self):
         """Start the SQLite DB"""
-        self.set_property("db_connection", TinyDB(self.get_property("database")))
+        # Keep the database in memory instead of re-reading the whole file on every query, and write it back on exit
+        storage = OrjsonStorage if orjson else JSONStorage
+        self.db_connection = TinyDB(self.database, storage=CachingMiddleware(storage), encoding="utf-8")
+        self.departure_keys = None
+        atexit.register(self.db_connection.close)
 
     def validate(self):
         """Validate inputs"""
         errors = []
-        if self.get_property("use_cache") and not self.get_property("database"):
+        if self.use_cache and not self.database:
             errors.append("Cache enabled but no database provided.")
-        if not self.get_property("use_cache") and not self.get_property("aeroapi_token"):
+        if not self.use_cache and not self.aeroapi_token:
             errors.append("Cache disabled, but no AeroAPI token set")
-        if not self.get_property("use_cache") and self.get_property("details") and not self.get_property("avwx_token"):
+        if not self.use_cache and self.details and not self.avwx_token:
             errors.append("Cache disabled and details are enabled, but no AVWX token set")
         return errors
 
     def load_rules(self):
         """Load the rules file"""
-        file = self.get_property("rules_file")
-        if file:
-            self.set_property("rules", json.load(file))
+        if self.rules_file:
+            self.rules = json.load(self.rules_file)
         else:
-            self.set_property("rules", {})
+            self.rules = {}
@@ -1,7 +1,7 @@
 """Main module."""
 import random
 import string
-import math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 import requests
 from requests.exceptions import HTTPError
@@ -9,10 +9,18 @@ from rich.console import Console
 from tinydb import TinyDB, where
 from atc_del_simulator import AdsConfig
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 AEROAPI_BASE_URL = "https://aeroapi.flightaware.com/aeroapi"
 AEROAPI_STD_SET_SIZE = 15
+AEROAPI_WARM_UP_TIMEOUT = 2
 AVWX_BASE_URL = "https://avwx.rest/api"
-VFR_AIRCRAFT_TYPES = [
+FETCH_MAX_WORKERS = 16
+VFR_IDENT_CHARACTERS = string.ascii_uppercase + string.digits
+VFR_AIRCRAFT_TYPES = (
     "BE33",
     "BE35",
     "BE50",
@@ -34,8 +42,8 @@ VFR_AIRCRAFT_TYPES = [
     "M20T",
     "P28A",
     "P28R",
-]
-VFR_ROUTES = [
+)
+VFR_ROUTES = (
     "N",
     "NE",
     "E",
@@ -45,42 +53,92 @@ VFR_ROUTES = [
     "W",
     "NW",
     "SFO",
-]
+)
+
+
+def parse_json_response(response: requests.Response):
+    """Parses the JSON body of a response, using orjson when it is installed"""
+    if orjson:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def get_stripped_value(data, key):
+    """Returns the stripped string value of a key, or an empty string if it is missing or empty"""
+    value = data.get(key)
+    return value.strip() if value else ""
+
+
+def get_departure_key(departure):
+    """Returns the fields which identify a unique departure in the database"""
+    return (
+        departure.get("ident"),
+        departure.get("aircraft_type"),
+        (departure.get("origin") or {}).get("code_icao"),
+        (departure.get("destination") or {}).get("code_icao"),
+        departure.get("operator_icao"),
+        departure.get("route"),
+    )
+
+
+def get_stored_departure_keys(ads_config: AdsConfig):
+    """Returns the keys of all stored departures, collecting them on first use"""
+    # Collect the keys once, instead of searching the table for every departure that might need to be stored
+    if ads_config.departure_keys is None:
+        database: TinyDB = ads_config.db_connection
+        ads_config.departure_keys = {get_departure_key(departure) for departure in database.table("departures").all()}
+    return ads_config.departure_keys
+
+
+def warm_up_aeroapi_connection(ads_config: AdsConfig):
+    """Opens a connection to AeroAPI ahead of the first real request, so that request skips the TCP and TLS setup"""
+    aeroapi_session: requests.Session = ads_config.aeroapi_session
+    if aeroapi_session and ads_config.has_aeroapi_key:
+        try:
+            aeroapi_session.head(url=AEROAPI_BASE_URL, timeout=AEROAPI_WARM_UP_TIMEOUT)
+        except requests.RequestException:
+            # The real requests report any connection problems
+            pass
 
 
 def fetch_departures(ads_config: AdsConfig, icao, number, waypoint):
     """Fetches the departures for a given ICAO for a random 4h time period and specified number of results and type"""
-    if ads_config.get_property("use_cache"):
-        database: TinyDB = ads_config.get_property("db_connection")
+    if number <= 0:
+        return []
+    if ads_config.use_cache:
+        database: TinyDB = ads_config.db_connection
         departure_table = database.table("departures")
+        # Departures without a route string are skipped, the waypoint is a plain substring of the route
         matching_departures = departure_table.search(
-            (where("origin")["code_icao"] == icao) & (where("route").matches(f".*{waypoint}.*"))
+            (where("origin")["code_icao"] == icao)
+            & where("route").test(lambda route: isinstance(route, str) and waypoint in route)
         )
         if len(matching_departures) <= number:
             return matching_departures
         return random.sample(matching_departures, number)
     else:
-        aeroapi_session: requests.Session = ads_config.get_property("aeroapi_session")
+        aeroapi_session: requests.Session = ads_config.aeroapi_session
         if aeroapi_session:
-            zulu_4h_ago = datetime.now(timezone.utc) - timedelta(hours=4)
-            zulu_10d_ago = datetime.now(timezone.utc) - timedelta(days=10)
+            zulu_now = datetime.now(timezone.utc)
+            zulu_4h_ago = zulu_now - timedelta(hours=4)
+            zulu_10d_ago = zulu_now - timedelta(days=10)
             random_start_time = zulu_10d_ago + ((zulu_4h_ago - zulu_10d_ago) * random.random())
             random_stop_time = random_start_time + timedelta(hours=4)
             params = {
-                "max_pages": math.floor(number / AEROAPI_STD_SET_SIZE) + 1,
-                "start": random_start_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "end": random_stop_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                # Only request as many pages as are needed to cover the number of departures
+                "max_pages": -(-number // AEROAPI_STD_SET_SIZE),
+                "start": random_start_time.isoformat(timespec="seconds").replace("+00:00", "Z"),
+                "end": random_stop_time.isoformat(timespec="seconds").replace("+00:00", "Z"),
             }
             dep_url = f"{AEROAPI_BASE_URL}/airports/{icao}/flights/departures"
             try:
                 # TODO Logging
                 dep_response = aeroapi_session.get(url=dep_url, params=params)
-                dep_json_response = dep_response.json()
-                if "departures" in dep_json_response.keys():
-                    return dep_json_response["departures"]
+                dep_json_response = parse_json_response(dep_response)
+                return (dep_json_response.get("departures") or [])[:number]
             except HTTPError as http_err:
                 # TODO replace by logging
-                console: Console = ads_config.get_property("rich_console")
+                console: Console = ads_config.rich_console
                 console.print_json(data=params)
                 console.print_exception(http_err)
     return []
@@ -88,89 +146,119 @@ def fetch_departures(ads_config: AdsConfig, icao, number, waypoint):
 
 def fetch_operator(ads_config: AdsConfig, icao):
     """Fetches the details of an operator based on its ICAO code"""
-    aeroapi_session: requests.Session = ads_config.get_property("aeroapi_session")
-    if ads_config.get_property("use_cache"):
-        database: TinyDB = ads_config.get_property("db_connection")
-        operator_table = database.table("operators")
-        matching_operators = operator_table.search(where("icao") == icao)
+    operator_table = None
+    db_lock = ads_config.db_lock
+    # Operator details hardly ever change, so a stored copy is used whenever a database is available
+    if ads_config.database:
+        # TinyDB creates its table objects on first use, so the table is resolved under the lock as well
+        with db_lock:
+            operator_table = ads_config.db_connection.table("operators")
+            matching_operators = operator_table.search(where("icao") == icao)
         if len(matching_operators) >= 1:
             return matching_operators[0]
-    if aeroapi_session and aeroapi_session.headers.get("x-apikey") and icao:
+    aeroapi_session: requests.Session = ads_config.aeroapi_session
+    if aeroapi_session and ads_config.has_aeroapi_key and icao:
         op_url = f"{AEROAPI_BASE_URL}/operators/{icao}"
         try:
             # TODO Logging
             op_response = aeroapi_session.get(url=op_url)
-            if ads_config.get_property("database"):
-                database: TinyDB = ads_config.get_property("db_connection")
-                operator_table = database.table("operators")
-                matching_operators = operator_table.search(where("icao") == icao)
-                if len(matching_operators) == 0 and not "status" in op_response.json():
-                    operator_table.insert(op_response.json())
-            return op_response.json()
+            operator_details = parse_json_response(op_response)
+            if operator_table is not None and "status" not in operator_details:
+                with db_lock:
+                    operator_table.upsert(operator_details, where("icao") == icao)
+            return operator_details
         except HTTPError as http_err:
             # TODO replace by logging
-            console: Console = ads_config.get_property("rich_console")
+            console: Console = ads_config.rich_console
             console.print_exception(http_err)
     return {}
 
 
 def fetch_aircraft(ads_config: AdsConfig, aircraft_type):
     """Fetches the details of an aircraft type"""
-    aeroapi_session: requests.Session = ads_config.get_property("aeroapi_session")
-    if ads_config.get_property("use_cache"):
-        database: TinyDB = ads_config.get_property("db_connection")
-        aircraft_type_table = database.table("aircraft_types")
-        matching_aircraft_types = aircraft_type_table.search(where("type") == aircraft_type)
+    aircraft_type_table = None
+    db_lock = ads_config.db_lock
+    # Aircraft type details hardly ever change, so a stored copy is used whenever a database is available
+    if ads_config.database:
+        # TinyDB creates its table objects on first use, so the table is resolved under the lock as well
+        with db_lock:
+            aircraft_type_table = ads_config.db_connection.table("aircraft_types")
+            matching_aircraft_types = aircraft_type_table.search(where("type") == aircraft_type)
         if len(matching_aircraft_types) >= 1:
             return matching_aircraft_types[0]
-    if aeroapi_session and aeroapi_session.headers.get("x-apikey") and aircraft_type:
+    aeroapi_session: requests.Session = ads_config.aeroapi_session
+    if aeroapi_session and ads_config.has_aeroapi_key and aircraft_type:
         at_url = f"{AEROAPI_BASE_URL}/aircraft/types/{aircraft_type}"
         try:
             # TODO Logging
             at_response = aeroapi_session.get(url=at_url)
-            if ads_config.get_property("database"):
-                database: TinyDB = ads_config.get_property("db_connection")
-                aircraft_type_table = database.table("aircraft_types")
-                matching_aircraft_types = aircraft_type_table.search(where("type") == aircraft_type)
-                if len(matching_aircraft_types) == 0 and not "status" in at_response.json():
-                    aircraft_type_details = at_response.json()
-                    aircraft_type_details["type"] = aircraft_type
-                    aircraft_type_table.insert(aircraft_type_details)
-            return at_response.json()
+            aircraft_type_details = parse_json_response(at_response)
+            if aircraft_type_table is not None and "status" not in aircraft_type_details:
+                with db_lock:
+                    aircraft_type_table.upsert(
+                        {**aircraft_type_details, "type": aircraft_type}, where("type") == aircraft_type
+                    )
+            return aircraft_type_details
         except HTTPError as http_err:
             # TODO replace by logging
-            console: Console = ads_config.get_property("rich_console")
+            console: Console = ads_config.rich_console
             console.print_exception(http_err)
     return {}
 
 
 def fetch_raw_metar(ads_config: AdsConfig, icao):
     """Fetches the current METAR of an airport based on its ICAO code"""
-    avwx_session: requests.Session = ads_config.get_property("avwx_session")
-    if avwx_session and avwx_session.headers.get("Authorization") and icao:
+    avwx_session: requests.Session = ads_config.avwx_session
+    if avwx_session and ads_config.has_avwx_key and icao:
         metar_url = f"{AVWX_BASE_URL}/metar/{icao}"
         try:
             # TODO Logging
             metar_response = avwx_session.get(url=metar_url)
-            metar_json_response = metar_response.json()
-            return metar_json_response["raw"] if "raw" in metar_json_response and metar_json_response["raw"] else ""
+            metar_json_response = parse_json_response(metar_response)
+            return metar_json_response.get("raw") or ""
         except HTTPError as http_err:
             # TODO replace by logging
-            console: Console = ads_config.get_property("rich_console")
+            console: Console = ads_config.rich_console
             console.print_exception(http_err)
     return ""
 
 
+def fetch_flight_plan_details(ads_config: AdsConfig, flight_plans):
+    """Fetches the operator and aircraft details for the flight plans, looking up each operator and type only once"""
+    operator_icaos = {flight_plan["operator_icao"] for flight_plan in flight_plans if flight_plan["operator_icao"]}
+    aircraft_types = {flight_plan["aircraft_type"] for flight_plan in flight_plans if flight_plan["aircraft_type"]}
+    with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as executor:
+        operator_futures = {
+            icao: executor.submit(fetch_operator, ads_config=ads_config, icao=icao) for icao in operator_icaos
+        }
+        aircraft_futures = {
+            aircraft_type: executor.submit(fetch_aircraft, ads_config=ads_config, aircraft_type=aircraft_type)
+            for aircraft_type in aircraft_types
+        }
+    operators = {icao: future.result() for icao, future in operator_futures.items()}
+    aircraft = {aircraft_type: future.result() for aircraft_type, future in aircraft_futures.items()}
+    for flight_plan in flight_plans:
+        flight_plan["operator_details"] = operators.get(flight_plan["operator_icao"], {})
+        flight_plan["aircraft_details"] = aircraft.get(flight_plan["aircraft_type"], {})
+    return flight_plans
+
+
 def generate_vfr_flight_plans(ads_config: AdsConfig, origin, number, details):
     """Returns a set of VFR requests"""
     flight_plans = []
     origin_metar = ""
-    if details and not ads_config.get_property("use_cache"):
+    if details and not ads_config.use_cache:
         origin_metar = fetch_raw_metar(ads_config=ads_config, icao=origin)
-    for _ in range(number):
+    # Draw all random values in a few batched calls rather than several calls per flight plan
+    ident_numbers = random.choices(range(100, 1000), k=number)
+    ident_characters = random.choices(VFR_IDENT_CHARACTERS, k=number * 2)
+    aircraft_types = random.choices(VFR_AIRCRAFT_TYPES, k=number)
+    routes = random.choices(VFR_ROUTES, k=number)
+    squawks = random.choices(range(100, 7000), k=number)
+    for index in range(number):
         flight_plan = {
-            "ident": f"N{random.randint(100,999)}{''.join(random.choices(string.ascii_uppercase + string.digits, k=2))}",
-            "aircraft_type": random.choice(VFR_AIRCRAFT_TYPES),
+            "ident": f"N{ident_numbers[index]}{ident_characters[index * 2]}{ident_characters[index * 2 + 1]}",
+            "aircraft_type": aircraft_types[index],
             "aircraft_details": {},
             "origin_icao": origin,
             "origin_details": {},
@@ -179,8 +267,9 @@ def generate_vfr_flight_plans(ads_config: AdsConfig, origin, number, details):
             "destination_details": {},
             "operator_icao": "",
             "operator_details": {},
-            "route": f"VFR {random.choice(VFR_ROUTES)}",
-            "squawk": random.randint(100, 6999),
+            "route": f"VFR {routes[index]}",
+            "flight_rules": "VFR",
+            "squawk": squawks[index],
             "rules_details": {},
         }
         flight_plans.append(flight_plan)
@@ -191,50 +280,41 @@ def get_ifr_flight_plans(ads_config: AdsConfig, origin, number, details, waypoin
     """Returns a set of flight plans for the user to look at with extra details if requested"""
     flight_plans = []
     origin_metar = ""
-    if details and not ads_config.get_property("use_cache"):
-        origin_metar = fetch_raw_metar(ads_config=ads_config, icao=origin)
+    use_cache = ads_config.use_cache
+    # The METAR and the departures come from different APIs, so fetch the METAR in the background
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        metar_future = None
+        if details and not use_cache:
+            metar_future = executor.submit(fetch_raw_metar, ads_config=ads_config, icao=origin)
+        departures = fetch_departures(ads_config=ads_config, icao=origin, number=number, waypoint=waypoint)
+        if metar_future:
+            origin_metar = metar_future.result()
 
-    departures = fetch_departures(ads_config=ads_config, icao=origin, number=number, waypoint=waypoint)
-    for departure in departures:
-        if len(flight_plans) >= number:
-            break
-        if ads_config.get_property("database") and not ads_config.get_property("use_cache"):
-            database: TinyDB = ads_config.get_property("db_connection")
-            departure_table = database.table("departures")
-            found_items = departure_table.search(
-                (where("ident") == departure["ident"])
-                & (where("aircraft_type") == departure["aircraft_type"])
-                & (where("origin")["code_icao"] == departure["origin"]["code_icao"])
-                & (where("destination")["code_icao"] == departure["destination"]["code_icao"])
-                & (where("operator_icao") == departure["operator_icao"])
-                & (where("route") == departure["route"])
-            )
-            if len(found_items) == 0:
-                departure_table.insert(departure)
-        ident = departure["ident"].strip() if "ident" in departure and departure["ident"] else ""
-        aircraft_type = (
-            departure["aircraft_type"].strip() if "aircraft_type" in departure and departure["aircraft_type"] else ""
-        )
-        origin_icao = (
-            departure["origin"]["code_icao"].strip()
-            if "origin" in departure and "code_icao" in departure["origin"] and departure["origin"]["code_icao"]
-            else ""
-        )
-        origin_details = departure["origin"] if "origin" in departure else ""
+    departure_table = None
+    stored_departure_keys = None
+    new_departures = []
+    if ads_config.database and not use_cache:
+        database: TinyDB = ads_config.db_connection
+        departure_table = database.table("departures")
+        stored_departure_keys = get_stored_departure_keys(ads_config)
+
+    # Draw all squawks at once, departures are already capped at the requested number by fetch_departures
+    squawks = random.sample(range(100, 7000), k=len(departures))
+    for departure, squawk in zip(departures, squawks):
+        if departure_table is not None:
+            departure_key = get_departure_key(departure)
+            if departure_key not in stored_departure_keys:
+                new_departures.append(departure)
+                stored_departure_keys.add(departure_key)
+        origin_details = departure.get("origin") or {}
+        destination_details = departure.get("destination") or {}
+        ident = get_stripped_value(departure, "ident")
+        aircraft_type = get_stripped_value(departure, "aircraft_type")
+        origin_icao = get_stripped_value(origin_details, "code_icao")
         origin_raw_metar = origin_metar
-        destination_icao = (
-            departure["destination"]["code_icao"].strip()
-            if "destination" in departure
-            and "code_icao" in departure["destination"]
-            and departure["destination"]["code_icao"]
-            else ""
-        )
-        destination_details = departure["destination"] if "destination" in departure else ""
-        operator_icao = (
-            departure["operator_icao"].strip() if "operator_icao" in departure and departure["operator_icao"] else ""
-        )
-        route = departure["route"].strip() if "route" in departure and departure["route"] else ""
-        squawk = random.randint(100, 6999)
+        destination_icao = get_stripped_value(destination_details, "code_icao")
+        operator_icao = get_stripped_value(departure, "operator_icao")
+        route = get_stripped_value(departure, "route")
         flight_plan = {
             "ident": ident,
             "aircraft_type": aircraft_type,
@@ -247,15 +327,26 @@ def get_ifr_flight_plans(ads_config: AdsConfig, origin, number, details, waypoin
             "operator_icao": operator_icao,
             "operator_details": {},
             "route": route,
+            "flight_rules": "IFR" if route and "VFR" not in route else "VFR",
             "squawk": squawk,
             "rules_details": {},
         }
         flight_plans.append(flight_plan)
+    # Every insert rewrites the whole database file, so store all new departures at once
+    if new_departures:
+        departure_table.insert_multiple(new_departures)
     return flight_plans
 
 
 def get_rules_info(ads_config: AdsConfig, flight_plan, runway_configuration):
     """Checks the rules for relevant information for the flight plan"""
+    route = flight_plan["route"]
+    # The rules details only depend on the route and runway configuration, so flight plans sharing a route reuse them
+    cache_key = (route, runway_configuration)
+    cached_rules_details = ads_config.rules_details_cache.get(cache_key)
+    if cached_rules_details is not None:
+        flight_plan["rules_details"] = dict(cached_rules_details)
+        return flight_plan["rules_details"]
     rules_details = {
         "dep_details": {},
         "dep_frequency": "",
@@ -265,54 +356,48 @@ def get_rules_info(ads_config: AdsConfig, flight_plan, runway_configuration):
         "vfr_altitude": "",
         "vfr_instructions": "",
     }
-    rules = ads_config.get_property("rules")
-    if flight_plan["route"] and "VFR" not in flight_plan["route"] and "ifr_departures" in rules and "sids" in rules:
+    rules = ads_config.rules
+    is_vfr = bool(route) and "VFR" in route
+    route_waypoints = route.split(" ") if route else []
+    if route and not is_vfr and "ifr_departures" in rules and "sids" in rules:
         # IFR flight plan
-        route_waypoints = flight_plan["route"].split(" ")
-        if route_waypoints[0] in rules["sids"] and runway_configuration in rules["runway_configurations"]:
-            sid = rules["sids"][route_waypoints[0]]
-            for ifr_departure in rules["ifr_departures"][runway_configuration]:
-                if ifr_departure["sid"] != route_waypoints[0]:
-                    continue
+        sid_name = route_waypoints[0]
+        if sid_name in rules["sids"] and runway_configuration in rules["runway_configurations"]:
+            sid = rules["sids"][sid_name]
+            route_waypoint_set = set(route_waypoints)
+            # The transition used by the route only depends on the SID, so it is looked up once
+            route_transition = next(
+                (transition for transition in sid["transitions"] if transition in route_waypoint_set), ""
+            )
+            for ifr_departure in ads_config.ifr_departure_index.get(runway_configuration, {}).get(sid_name, ()):
                 rules_details["sid_details"] = sid
                 # If there are no waypoints mentioned in the ifr_departure, but it matches, it auto applies
                 if len(ifr_departure["waypoints"]) == 0:
                     rules_details["dep_details"] = ifr_departure
-                    for transition in sid["transitions"]:
-                        if transition in route_waypoints:
-                            rules_details["dep_transition"] = transition
-                            break
-                    for waypoint in route_waypoints:
-                        if waypoint in sid["waypoints"]:
-                            rules_details["dep_waypoint"] = waypoint
-                            break
+                    rules_details["dep_transition"] = route_transition
+                    sid_waypoints = set(sid["waypoints"])
+                    rules_details["dep_waypoint"] = next(
+                        (waypoint for waypoint in route_waypoints if waypoint in sid_waypoints), ""
+                    )
                     break
                 # Check if the transition exists in the route, if so the departure is using the transition
-                for transition in sid["transitions"]:
-                    if transition in route_waypoints:
-                        rules_details["dep_transition"] = transition
-                        rules_details["dep_waypoint"] = transition
-                        break
-                if rules_details["dep_transition"]:
+                if route_transition:
+                    rules_details["dep_transition"] = route_transition
+                    rules_details["dep_waypoint"] = route_transition
                     rules_details["dep_details"] = ifr_departure
                     break
                 # Check if any of the waypoints exist in the route,
                 # if so the departure is just using a waypoint not a transition
-                for waypoint in route_waypoints:
-                    if waypoint in ifr_departure["waypoints"]:
-                        rules_details["dep_waypoint"] = waypoint
-                        break
+                departure_waypoints = set(ifr_departure["waypoints"])
+                rules_details["dep_waypoint"] = next(
+                    (waypoint for waypoint in route_waypoints if waypoint in departure_waypoints), ""
+                )
                 if rules_details["dep_waypoint"]:
                     rules_details["dep_details"] = ifr_departure
                     break
-    if (
-        flight_plan["route"]
-        and "VFR" in flight_plan["route"]
-        and "vfr_departures" in rules
-        and runway_configuration in rules["runway_configurations"]
-    ):
+    if route and is_vfr and "vfr_departures" in rules and runway_configuration in rules["runway_configurations"]:
         # VFR flight plan
-        vfr_direction = flight_plan["route"].split(" ")[1]
+        vfr_direction = route_waypoints[1]
         for vfr_departure in rules["vfr_departures"][runway_configuration]:
             if vfr_direction in vfr_departure["direction"]:
                 rules_details["dep_details"] = vfr_departure
@@ -328,5 +413,6 @@ def get_rules_info(ads_config: AdsConfig, flight_plan, runway_configuration):
             rules_details["dep_details"]["departure_frequency"]
         ]
 
-    flight_plan["rules_details"] = rules_details
-    return rules_details
+    ads_config.rules_details_cache[cache_key] = rules_details
+    flight_plan["rules_details"] = dict(rules_details)
+    return flight_plan["rules_details"]
@@ -1,22 +1,88 @@
 """Console script for atc_del_simulator."""
 import sys
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import rich_click as click
-from rich.console import Console
+from rich import box
+from rich.console import Console, Group
+from rich.panel import Panel
+from rich.rule import Rule
 from rich.table import Table
 from rich.prompt import Prompt
 from tinydb import TinyDB, where, Query
 from atc_del_simulator import (
     AdsConfig,
     get_ifr_flight_plans,
-    fetch_aircraft,
-    fetch_operator,
+    fetch_flight_plan_details,
     generate_vfr_flight_plans,
     get_rules_info,
+    warm_up_aeroapi_connection,
 )
 
 pass_ads_config = click.make_pass_decorator(AdsConfig, ensure=True)
 
+FIELD_TABLE_COLUMN_WIDTHS = (15, 15, 15, 15, 15, 15)
+ROUTE_TABLE_COLUMN_WIDTHS = (15, 75)
+DETAIL_TABLE_COLUMN_WIDTHS = (20, 20, 20, 30)
+WIDE_DETAIL_TABLE_COLUMN_WIDTHS = (20, 70)
+FLIGHT_PLAN_PANEL_WIDTH = 104
+
+
+def create_grid_table(column_widths):
+    """Creates a borderless table without header with alternating right justified labels and left justified values"""
+    table = Table(padding=(0, 0), show_edge=False, show_lines=False, show_header=False)
+    for index, width in enumerate(column_widths):
+        table.add_column(justify="left" if index % 2 else "right", width=width)
+    return table
+
+
+def create_flight_plan_panel(title, items):
+    """Creates the framed flight plan view, rendering the items below each other"""
+    return Panel(Group(*items), box=box.SQUARE, title=title, title_align="left", width=FLIGHT_PLAN_PANEL_WIDTH)
+
+
+def build_ifr_clearance(flight_plan, origin_icao, rules_details):
+    """Builds the IFR clearance for a flight plan from its rules details"""
+    sid_details = rules_details["sid_details"]
+    dep_details = rules_details["dep_details"]
+    clearance_parts = [f'{flight_plan["ident"]}, {origin_icao} GND, Cleared to {flight_plan["destination_icao"]}, ']
+    if sid_details:
+        clearance_parts.append(f'{sid_details["name"]} departure, ')
+    else:
+        clearance_parts.append("direct, ")
+    if rules_details["dep_transition"]:
+        clearance_parts.append(f'{rules_details["dep_transition"]} transition, then as filed, ')
+    elif rules_details["dep_waypoint"]:
+        if sid_details and sid_details["type"] == "RADAR":
+            clearance_parts.append("Radar vectors ")
+        clearance_parts.append(f'{rules_details["dep_waypoint"]}, then as filed, ')
+    if dep_details and dep_details["cvs"]:
+        clearance_parts.append("Climb via SID, ")
+        if dep_details["top_altitude"] != "SID":
+            clearance_parts.append(f'Except maintain {dep_details["top_altitude"]}, ')
+    elif dep_details:
+        clearance_parts.append(f'Maintain {dep_details["top_altitude"]}, ')
+    if rules_details["dep_frequency"]:
+        clearance_parts.append(f'Departure frequency {rules_details["dep_frequency"]}, ')
+    if flight_plan["squawk"]:
+        clearance_parts.append(f'Squawk {flight_plan["squawk"]:04d}')
+    return "".join(clearance_parts)
+
+
+def build_vfr_clearance(flight_plan, origin_icao, rules_details):
+    """Builds the VFR clearance for a flight plan from its rules details"""
+    clearance_parts = [f'{flight_plan["ident"]}, {origin_icao} GND, ']
+    if rules_details["vfr_instructions"]:
+        clearance_parts.append(f'On departure {rules_details["vfr_instructions"]}, ')
+    if rules_details["vfr_altitude"]:
+        clearance_parts.append(f'Maintain VFR {rules_details["vfr_altitude"]}, ')
+    if rules_details["dep_frequency"]:
+        clearance_parts.append(f'Departure frequency {rules_details["dep_frequency"]}, ')
+    if flight_plan["squawk"]:
+        clearance_parts.append(f'Squawk {flight_plan["squawk"]:04d}')
+    return "".join(clearance_parts)
+
 
 @click.group()
 @click.option(
@@ -78,7 +144,7 @@ def cli(ads_config: AdsConfig, aeroapi_token, avwx_token, database, rules_file,
     help=(
         "Use cache for reading data, must also use `--db` flag on main command to determine the database. When no-cache"
         " is used, information will be pulled from the API and if `--db` is enabled, it will be written to the"
-        " SQLite DB."
+        " SQLite DB. Operator and aircraft type details are read from the database whenever it contains them."
     ),
 )
 @click.option(
@@ -115,6 +181,9 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
     ads_config.set_property("use_cache", cache)
     ads_config.set_property("details", details)
     console: Console = ads_config.get_property("rich_console")
+    verbose = ads_config.get_property(property_name="verbose")
+    database = ads_config.get_property(property_name="database")
+    rules_file = ads_config.get_property(property_name="rules_file")
     validation_errors = ads_config.validate()
     if len(validation_errors) > 0:
         console.stderr = True
@@ -122,8 +191,12 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
         for error in validation_errors:
             console.print(error, style="bold red")
         sys.exit(10)
+    if not cache and ads_config.get_property(property_name="aeroapi_token"):
+        # Connect to AeroAPI in the background while the options are shown and the spinner starts, the departures
+        # and the operator and aircraft type details of both IFR and VFR flight plans are fetched from it
+        threading.Thread(target=warm_up_aeroapi_connection, kwargs={"ads_config": ads_config}, daemon=True).start()
     vfr_number = vfr_number if vfr_number < number else number
-    if ads_config.get_property(property_name="verbose"):
+    if verbose:
         table = Table(title="Invoked options")
         table.add_column("Option", justify="left")
         table.add_column("Value", justify="right")
@@ -131,16 +204,14 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
         table.add_row("AVWX token", ads_config.get_property(property_name="avwx_token"))
         table.add_row(
             "Verbose",
-            ":white_check_mark:" if ads_config.get_property(property_name="verbose") else ":x:",
+            ":white_check_mark:" if verbose else ":x:",
         )
         table.add_row(
             "Use cache",
-            ":white_check_mark:" if ads_config.get_property(property_name="use_cache") else ":x:",
-        )
-        table.add_row("Database", ads_config.get_property("database"))
-        table.add_row(
-            "Rules file", ads_config.get_property("rules_file").name if ads_config.get_property("rules_file") else ""
+            ":white_check_mark:" if cache else ":x:",
         )
+        table.add_row("Database", database)
+        table.add_row("Rules file", rules_file.name if rules_file else "")
         table.add_row("Details", ":white_check_mark:" if details else ":x:")
         table.add_row("Number", f"{number}")
         table.add_row("Origin ICAO", origin_icao)
@@ -150,34 +221,38 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
     console.clear()
 
     with console.status("Loading flight plans..."):
-        flight_plans = []
-        if number > 0:
-            ifr_flight_plans = get_ifr_flight_plans(
-                ads_config=ads_config,
-                origin=origin_icao,
-                number=number - vfr_number,
-                details=details,
-                waypoint=waypoint,
-            )
-            flight_plans.extend(ifr_flight_plans)
-        if vfr_number > 0:
-            vfr_flight_plans = generate_vfr_flight_plans(
-                ads_config=ads_config, origin=origin_icao, number=vfr_number, details=details
-            )
-            flight_plans.extend(vfr_flight_plans)
-        random.shuffle(flight_plans)
+        # The IFR flight plans wait on AeroAPI, so the VFR flight plans are generated alongside them
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            ifr_future = None
+            vfr_future = None
+            if number > 0:
+                ifr_future = executor.submit(
+                    get_ifr_flight_plans,
+                    ads_config=ads_config,
+                    origin=origin_icao,
+                    number=number - vfr_number,
+                    details=details,
+                    waypoint=waypoint,
+                )
+            if vfr_number > 0:
+                vfr_future = executor.submit(
+                    generate_vfr_flight_plans,
+                    ads_config=ads_config,
+                    origin=origin_icao,
+                    number=vfr_number,
+                    details=details,
+                )
+        loaded_flight_plans = (ifr_future.result() if ifr_future else []) + (vfr_future.result() if vfr_future else [])
+        flight_plans = random.sample(loaded_flight_plans, k=len(loaded_flight_plans))
+        if details:
+            fetch_flight_plan_details(ads_config=ads_config, flight_plans=flight_plans)
+    show_rules = bool(ads_config.get_property(property_name="rules")) and bool(runway_configuration)
     count = 0
     for flight_plan in flight_plans:
         count += 1
         console.clear()
-        flight_rules = "IFR" if flight_plan["route"] and not "VFR" in flight_plan["route"] else "VFR"
-        field_table = Table(padding=(0, 0), show_edge=False, show_lines=False, show_header=False)
-        field_table.add_column(justify="right", width=15)
-        field_table.add_column(justify="left", width=15)
-        field_table.add_column(justify="right", width=15)
-        field_table.add_column(justify="left", width=15)
-        field_table.add_column(justify="right", width=15)
-        field_table.add_column(justify="left", width=15)
+        flight_rules = flight_plan["flight_rules"]
+        field_table = create_grid_table(FIELD_TABLE_COLUMN_WIDTHS)
         field_table.add_row(
             "Callsign",
             flight_plan["ident"],
@@ -195,19 +270,14 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
             "",
         )
         field_table.add_row("Cruise Alt", "N/A", "Scratchpad", "", "Squawk", f'{flight_plan["squawk"]:04d}')
-        route_table = Table(padding=(0, 0), show_edge=False, show_lines=False, show_header=False)
-        route_table.add_column(justify="right", width=15)
-        route_table.add_column(justify="left", width=75)
+        route_table = create_grid_table(ROUTE_TABLE_COLUMN_WIDTHS)
         route_table.add_row("Route", flight_plan["route"])
-        top_table = Table(
-            title=f'Flight Plan - {flight_plan["ident"]} - {count}/{number}{" - " + runway_configuration if runway_configuration else ""}',
-            show_header=False,
-            title_justify="left",
+        flight_plan_title = (
+            f'Flight Plan - {flight_plan["ident"]} - {count}/{number}'
+            f'{" - " + runway_configuration if runway_configuration else ""}'
         )
-        top_table.add_column(justify="left", width=100)
-        top_table.add_row(field_table)
-        top_table.add_row(route_table)
-        console.print(top_table)
+        flight_plan_items = [field_table, route_table]
+        console.print(create_flight_plan_panel(flight_plan_title, flight_plan_items))
         command = Prompt.ask(
             "Select an action (d)etails or (N)ext" if details else "Press enter to view the (N)ext flight plan",
             choices=["D", "n"] if details else ["N"],
@@ -215,33 +285,23 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
         )
 
         if details and command == "D":
-            with console.status("Loading operator and aircraft details..."):
-                flight_plan["operator_details"] = fetch_operator(
-                    ads_config=ads_config, icao=flight_plan["operator_icao"].strip()
-                )
-                flight_plan["aircraft_details"] = fetch_aircraft(
-                    ads_config=ads_config, aircraft_type=flight_plan["aircraft_type"].strip()
-                )
+            # Only look up details again for an operator or aircraft type whose earlier lookup came back empty
+            if (flight_plan["operator_icao"] and not flight_plan["operator_details"]) or (
+                flight_plan["aircraft_type"] and not flight_plan["aircraft_details"]
+            ):
+                with console.status("Loading operator and aircraft details..."):
+                    fetch_flight_plan_details(ads_config=ads_config, flight_plans=[flight_plan])
 
-            operator_callsign = (
-                flight_plan["operator_details"]["callsign"] if "callsign" in flight_plan["operator_details"] else ""
-            )
+            operator_callsign = flight_plan["operator_details"].get("callsign") or ""
+            aircraft = flight_plan["aircraft_details"]
             aircraft_details = (
-                f'{flight_plan["aircraft_details"]["manufacturer"]} {flight_plan["aircraft_details"]["type"]} -'
-                f' {flight_plan["aircraft_details"]["description"]}'
-                if "type" in flight_plan["aircraft_details"]
-                else ""
-            )
-            destination_name = (
-                f'{flight_plan["destination_details"]["name"]} - {flight_plan["destination_details"]["city"]}'
-                if "name" in flight_plan["destination_details"]
+                f'{aircraft["manufacturer"]} {aircraft["type"]} - {aircraft["description"]}'
+                if "type" in aircraft
                 else ""
             )
-            data_table = Table(padding=(0, 0), show_edge=False, show_lines=False, show_header=False)
-            data_table.add_column(justify="right", width=20)
-            data_table.add_column(justify="left", width=20)
-            data_table.add_column(justify="right", width=20)
-            data_table.add_column(justify="left", width=30)
+            destination = flight_plan["destination_details"]
+            destination_name = f'{destination["name"]} - {destination["city"]}' if "name" in destination else ""
+            data_table = create_grid_table(DETAIL_TABLE_COLUMN_WIDTHS)
             data_table.add_row(
                 "Dest. ICAO",
                 flight_plan["destination_icao"],
@@ -260,25 +320,17 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
                 "Aircraft Details",
                 aircraft_details,
             )
-            metar_table = Table(padding=(0, 0), show_edge=False, show_lines=False, show_header=False)
-            metar_table.add_column(justify="right", width=20)
-            metar_table.add_column(justify="left", width=70)
+            metar_table = create_grid_table(WIDE_DETAIL_TABLE_COLUMN_WIDTHS)
             metar_table.add_row("Origin METAR", flight_plan["origin_raw_metar"])
-            top_table.add_section()
-            top_table.add_row(data_table)
-            top_table.add_row(metar_table)
-            if ads_config.get_property("rules") and runway_configuration:
-                top_table.add_section()
+            flight_plan_items.extend((Rule(style=""), data_table, metar_table))
+            if show_rules:
+                flight_plan_items.append(Rule(style=""))
                 rules_details = get_rules_info(
                     ads_config=ads_config, flight_plan=flight_plan, runway_configuration=runway_configuration
                 )
-                rules_table = Table(padding=(0, 0), show_edge=False, show_lines=False, show_header=False)
-                rules_table.add_column(justify="right", width=20)
-                rules_table.add_column(justify="left", width=20)
-                rules_table.add_column(justify="right", width=20)
-                rules_table.add_column(justify="left", width=30)
-                full_clearance = ""
-                if "VFR" not in flight_plan["route"]:
+                rules_table = create_grid_table(DETAIL_TABLE_COLUMN_WIDTHS)
+                # Flight plans without a route are shown as VFR, but still get the IFR rules details
+                if flight_rules == "IFR" or not flight_plan["route"]:
                     rules_table.add_row(
                         "SID",
                         rules_details["sid_details"]["name"] if rules_details["sid_details"] else "",
@@ -302,56 +354,23 @@ def route(ads_config: AdsConfig, origin_icao, cache, details, number, runway_con
                         if rules_details["dep_details"]
                         else "",
                     )
-                    full_clearance = (
-                        f'{flight_plan["ident"]}, {origin_icao} GND, Cleared to {flight_plan["destination_icao"]}, '
-                    )
-                    if rules_details["sid_details"]:
-                        full_clearance += f'{rules_details["sid_details"]["name"]} departure, '
-                    else:
-                        full_clearance += "direct, "
-                    if rules_details["dep_transition"]:
-                        full_clearance += f'{rules_details["dep_transition"]} transition, then as filed, '
-                    elif rules_details["dep_waypoint"]:
-                        if rules_details["sid_details"] and rules_details["sid_details"]["type"] == "RADAR":
-                            full_clearance += "Radar vectors "
-                        full_clearance += f'{rules_details["dep_waypoint"]}, then as filed, '
-                    if rules_details["dep_details"] and rules_details["dep_details"]["cvs"]:
-                        full_clearance += "Climb via SID, "
-                        if rules_details["dep_details"]["top_altitude"] != "SID":
-                            full_clearance += f'Except maintain {rules_details["dep_details"]["top_altitude"]}, '
-                    elif rules_details["dep_details"]:
-                        full_clearance += f'Maintain {rules_details["dep_details"]["top_altitude"]}, '
-                    if rules_details["dep_frequency"]:
-                        full_clearance += f'Departure frequency {rules_details["dep_frequency"]}, '
-                    if flight_plan["squawk"]:
-                        full_clearance += f'Squawk {flight_plan["squawk"]:04d}'
+                    full_clearance = build_ifr_clearance(flight_plan, origin_icao, rules_details)
                 else:
-                    vfr_table = Table(padding=(0, 0), show_edge=False, show_lines=False, show_header=False)
-                    vfr_table.add_column(justify="right", width=20)
-                    vfr_table.add_column(justify="left", width=70)
+                    vfr_table = create_grid_table(WIDE_DETAIL_TABLE_COLUMN_WIDTHS)
                     vfr_table.add_row("VFR Instructions", rules_details["vfr_instructions"])
-                    top_table.add_row(vfr_table)
+                    flight_plan_items.append(vfr_table)
                     rules_table.add_row(
                         "VFR Altitude",
                         rules_details["vfr_altitude"],
                         "Dep Frequency",
                         rules_details["dep_frequency"],
                     )
-                    full_clearance = f'{flight_plan["ident"]}, {origin_icao} GND, '
-                    if rules_details["vfr_instructions"]:
-                        full_clearance += f'On departure {rules_details["vfr_instructions"]}, '
-                    if rules_details["vfr_altitude"]:
-                        full_clearance += f'Maintain VFR {rules_details["vfr_altitude"]}, '
-                    if rules_details["dep_frequency"]:
-                        full_clearance += f'Departure frequency {rules_details["dep_frequency"]}, '
-                    if flight_plan["squawk"]:
-                        full_clearance += f'Squawk {flight_plan["squawk"]:04d}'
-                top_table.add_row(rules_table)
+                    full_clearance = build_vfr_clearance(flight_plan, origin_icao, rules_details)
+                flight_plan_items.append(rules_table)
                 if full_clearance:
-                    top_table.add_section()
-                    top_table.add_row(full_clearance)
+                    flight_plan_items.extend((Rule(style=""), full_clearance))
             console.clear()
-            console.print(top_table)
+            console.print(create_flight_plan_panel(flight_plan_title, flight_plan_items))
             Prompt.ask("Press enter to view the (N)ext flight plan", choices=["N"], default="N")
 
 
@@ -363,22 +382,34 @@ def stats(ads_config: AdsConfig, search_term):
     console: Console = ads_config.get_property("rich_console")
     if ads_config.get_property("database"):
         database: TinyDB = ads_config.get_property("db_connection")
+
+        def contains_search_term(value):
+            """Checks if a stored value is a string containing the search term"""
+            return isinstance(value, str) and search_term in value
+
         departure_table = database.table("departures")
-        matching_departures = departure_table.search(
-            (where("origin")["code_icao"].matches(f".*{search_term}.*"))
-            | (where("destination")["code_icao"].matches(f".*{search_term}.*"))
-            | (where("route").matches(f".*{search_term}.*"))
-        )
         operator_table = database.table("operators")
-        matching_operators = operator_table.search(where("icao").matches(f".*{search_term}.*"))
         aircraft_type_table = database.table("aircraft_types")
-        matching_aircraft_types = aircraft_type_table.search(where("type").matches(f".*{search_term}.*"))
+        if search_term:
+            # A single pass over the departures checks all three fields, instead of one regex query per field
+            departure_count = departure_table.count(
+                lambda departure: contains_search_term((departure.get("origin") or {}).get("code_icao"))
+                or contains_search_term((departure.get("destination") or {}).get("code_icao"))
+                or contains_search_term(departure.get("route"))
+            )
+            operator_count = operator_table.count(where("icao").test(contains_search_term))
+            aircraft_type_count = aircraft_type_table.count(where("type").test(contains_search_term))
+        else:
+            # Without a search term every record counts, so the table sizes are used instead of searching
+            departure_count = len(departure_table)
+            operator_count = len(operator_table)
+            aircraft_type_count = len(aircraft_type_table)
         table = Table(title="Database stats")
         table.add_column("Table", justify="left")
         table.add_column("# Records", justify="right")
-        table.add_row("departures", f"{len(matching_departures)}")
-        table.add_row("operators", f"{len(matching_operators)}")
-        table.add_row("aircraft_types", f"{len(matching_aircraft_types)}")
+        table.add_row("departures", f"{departure_count}")
+        table.add_row("operators", f"{operator_count}")
+        table.add_row("aircraft_types", f"{aircraft_type_count}")
         console.print(table)
     else:
         console.stderr = True
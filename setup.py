@@ -19,6 +19,10 @@ requirements = [
     'tinydb>=4.8'
 ]
 
+extra_requirements = {
+    'speedups': ['orjson>=3.9'],
+}
+
 test_requirements = [ ]
 
 setup(
@@ -40,6 +44,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="GNU General Public License v3",
     long_description=readme + '\n\n' + history,
     include_package_data=True,